@@ -2,24 +2,75 @@ from __future__ import annotations
 
 import argparse
 import hashlib
+import io
 import logging
+import mmap
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
-from sqlalchemy import Boolean, Column, DateTime, Integer, String, Text, create_engine
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Column,
+    DateTime,
+    Integer,
+    String,
+    Text,
+    create_engine,
+    event,
+    insert,
+    select,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session, declarative_base, sessionmaker
 
 session: Session
 
 logger = logging.getLogger(__name__)
 
+CHUNK_SIZE = 1 << 20
+MMAP_THRESHOLD = 64 << 10
+BATCH_SIZE = 1000
+
+# Ids of the creators and collections already seen during this run
+_creator_cache: dict[str, int] = {}
+_collection_cache: dict[tuple[str, int | None], int] = {}
+
 
 class MockSession:
     def add(self, model):
         logger.info("Adding %s", model)
+        if not logger.isEnabledFor(logging.INFO):
+            return
         for column in model.__table__.columns:
             logger.info("  %s: %s", column.name, getattr(model, column.name))
 
+    def add_all(self, models):
+        for model in models:
+            self.add(model)
+
+    def execute(self, statement, params=None):
+        logger.info("Executing %s", statement)
+        for row in params or []:
+            logger.info("  %s", row)
+        return self
+
+    def __iter__(self):
+        return iter(())
+
+    def scalar(self):
+        return None
+
+    def flush(self):
+        logger.info("Flushing")
+
     def commit(self):
         logger.info("Committing")
 
@@ -160,68 +211,321 @@ class ModelFile(Base):
     caption = Column(Text)
     size = Column(Integer)
     presupported_version_id = Column(Integer)
+    # Not part of the Manyfold schema, only written with --fast-hash:
+    # ALTER TABLE model_files ADD COLUMN fast_digest character varying;
+    fast_digest = Column(String)
+    # Not part of the Manyfold schema, only written with --reuse-digests:
+    # ALTER TABLE model_files ADD COLUMN mtime_ns bigint;
+    mtime_ns = Column(BigInteger)
 
 
 def sanitize_path(root_folder, path):
     return path.relative_to(root_folder)
 
 
-def insert_model_files(session, model_id, root_folder):
-    for path in root_folder.iterdir():
-        if path.is_file():
-            logger.info("Processing file %s", path.name)
-            model_file = ModelFile(
-                filename=path.name,
-                model_id=model_id,
-                created_at=datetime.now(),
-                updated_at=datetime.now(),
-                presupported=False,
-                y_up=False,
-                digest=calculate_digest(path),
-                notes="",
-                caption="",
-                size=path.stat().st_size,
-                presupported_version_id=None,
-            )
-            session.add(model_file)
-            session.commit()
-        elif path.is_dir():
-            logger.info("Processing directory %s", path.name)
-            insert_model_files(session, model_id, path)
+def scandir(folder):
+    with os.scandir(folder) as it:
+        return list(it)
+
+
+def list_files(root_folder):
+    return list(walk_files(root_folder))
+
+
+def walk_files(root_folder):
+    folders = deque([root_folder])
+    while folders:
+        with os.scandir(folders.popleft()) as it:
+            for entry in it:
+                if entry.is_file():
+                    yield entry.path, entry.name, entry.stat()
+                # Symlinked subdirectories are not followed, they could loop
+                elif entry.is_dir(follow_symlinks=False):
+                    logger.info("Processing directory %s", entry.name)
+                    folders.append(entry.path)
+                elif entry.is_dir():
+                    logger.info("Skipping symlinked directory %s", entry.name)
+
+
+def digest_files(batch, executor=None, fast_hash=False):
+    """Return a {path: hexdigest} mapping for the (files, known) pairs of a batch"""
+    digests = {}
+    to_digest = []
+    for files, known in batch:
+        known = known or {}
+        for path, name, stat in files:
+            digest = known_digest(stat, known.get(name))
+            if digest is None:
+                to_digest.append((stat.st_size, path))
+            else:
+                digests[path] = digest
+    # Largest files first, so that a big file doesn't start last and keep
+    # a single worker busy after the others are done
+    to_digest.sort(reverse=True)
+    digests.update(
+        digest_batch(
+            [path for _, path in to_digest],
+            executor,
+            calculate_fast_digest if fast_hash else calculate_digest,
+        )
+    )
+    return digests
+
+
+def insert_model_files(
+    session,
+    model_id,
+    files,
+    digests,
+    fast_hash=False,
+    use_copy=False,
+    now=None,
+    reuse_digests=False,
+):
+    now = now or datetime.now()
+    template = dict(
+        model_id=model_id,
+        created_at=now,
+        updated_at=now,
+        presupported=False,
+        y_up=False,
+        digest=None,
+        notes="",
+        caption="",
+        presupported_version_id=None,
+    )
+    digest_column = "fast_digest" if fast_hash else "digest"
+    rows = []
+    for path, name, stat in files:
+        logger.info("Processing file %s", name)
+        row = dict(template, filename=name, size=stat.st_size)
+        row[digest_column] = digests[path]
+        if reuse_digests:
+            row["mtime_ns"] = stat.st_mtime_ns
+        rows.append(row)
+        if len(rows) >= BATCH_SIZE:
+            write_model_files(session, rows, use_copy)
+            rows = []
+    if rows:
+        write_model_files(session, rows, use_copy)
+
+
+def write_model_files(session, rows, use_copy=False):
+    if use_copy:
+        copy_rows(session, ModelFile.__table__, rows)
+    else:
+        session.execute(insert(ModelFile.__table__), rows)
+
+
+def copy_rows(session, table, rows):
+    """Stream rows into table with COPY FROM STDIN, in PostgreSQL text format"""
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(copy_value(row[column]) for column in columns))
+        buffer.write("\n")
+    statement = f"COPY {table.name} ({', '.join(columns)}) FROM STDIN"
+    cursor = session.connection().connection.cursor()
+    try:
+        if hasattr(cursor, "copy_expert"):
+            # psycopg2
+            buffer.seek(0)
+            cursor.copy_expert(statement, buffer)
+        else:
+            # psycopg
+            with cursor.copy(statement) as copy:
+                copy.write(buffer.getvalue())
+    finally:
+        cursor.close()
+
+
+def copy_value(value):
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def known_digest(stat, known_file):
+    """Return the stored digest if the file didn't change since it was computed"""
+    if known_file is None:
+        return None
+    size, mtime_ns, digest = known_file
+    if stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+        return None
+    return digest
+
+
+def load_known_files(session, models):
+    """Map model path -> filename -> (size, mtime_ns, digest) for stored files"""
+    statement = (
+        select(
+            Model.path,
+            ModelFile.filename,
+            ModelFile.size,
+            ModelFile.mtime_ns,
+            ModelFile.digest,
+        )
+        .join(Model, Model.id == ModelFile.model_id)
+        .where(
+            Model.library_id == models[0].library_id,
+            Model.path.in_([model.path for model in models]),
+            ModelFile.mtime_ns.is_not(None),
+            ModelFile.digest.is_not(None),
+        )
+    )
+    known = {}
+    for path, filename, size, mtime_ns, digest in session.execute(statement):
+        known.setdefault(path, {})[filename] = (size, mtime_ns, digest)
+    return known
 
 
 def calculate_digest(file):
     """In JS it's Digest::SHA512.new.file(pathname).hexdigest"""
-    return hashlib.sha512(file.read_bytes()).hexdigest()
+    digest = hashlib.sha512()
+    with open(file, "rb", buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < MMAP_THRESHOLD:
+            digest.update(f.readall())
+            return digest.hexdigest()
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for advice in ("MADV_SEQUENTIAL", "MADV_WILLNEED"):
+                    if hasattr(mmap, advice):
+                        mm.madvise(getattr(mmap, advice))
+                digest.update(mm)
+            return digest.hexdigest()
+        except OSError:
+            # Some network and FUSE filesystems don't support mmap
+            logger.debug("Cannot mmap %s, streaming it instead", file)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        for chunk in read_chunks(f):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_chunks(f):
+    """Yield the chunks of f, reading the next one while the current is hashed"""
+    current = memoryview(bytearray(CHUNK_SIZE))
+    following = memoryview(bytearray(CHUNK_SIZE))
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        size = f.readinto(current)
+        while size:
+            future = reader.submit(f.readinto, following)
+            yield current[:size]
+            size = future.result()
+            current, following = following, current
+
+
+def calculate_fast_digest(file):
+    """BLAKE3 digest, leaving the SHA-512 one to be computed later by Manyfold"""
+    return blake3.blake3(max_threads=blake3.blake3.AUTO).update_mmap(file).hexdigest()
+
+
+def digest_batch(paths, executor=None, function=calculate_digest):
+    """Return a {path: hexdigest} mapping for all the given files"""
+    if executor is None:
+        return {path: function(path) for path in paths}
+    return dict(zip(paths, executor.map(function, paths)))
 
 
 # Function to recursively traverse the folder structure and insert data into the table
-def insert_folders(session, root_folder, library_id):
-    for creator_path in root_folder.iterdir():
-        logger.info("Processing creator %s", creator_path.name)
-        for collection_path in creator_path.iterdir():
-            logger.info("Processing collection %s", collection_path.name)
-            for model_path in collection_path.iterdir():
-                if not model_path.is_dir():
+def insert_folders(
+    session,
+    root_folder,
+    library_id,
+    executor=None,
+    fast_hash=False,
+    use_copy=False,
+    reuse_digests=False,
+):
+    warm_caches(session)
+    # Every row written in the same batch shares the same timestamp
+    now = datetime.now()
+    pending = []
+    for creator_entry in scandir(root_folder):
+        logger.info("Processing creator %s", creator_entry.name)
+        for collection_entry in scandir(creator_entry.path):
+            logger.info("Processing collection %s", collection_entry.name)
+            for model_entry in scandir(collection_entry.path):
+                if not model_entry.is_dir():
                     continue
-                logger.info("Processing model %s", model_path.name)
+                logger.info("Processing model %s", model_entry.name)
+                model_path = Path(model_entry.path)
 
                 creator, collection, model_name, uuid = get_infos(model_path)
 
-                creator_id = get_or_create_creator(session, creator).id
-                collection_id = get_or_create_collection(session, collection, None).id
+                creator_id = get_or_create_creator(session, creator, now)
+                collection_id = get_or_create_collection(session, collection, None, now)
                 model = Model(
                     name=model_path.name,
                     path=str(sanitize_path(root_folder, model_path)),
                     library_id=library_id,
-                    created_at=datetime.now(),
-                    updated_at=datetime.now(),
+                    created_at=now,
+                    updated_at=now,
                     creator_id=creator_id,
                     collection_id=collection_id,
                 )
-                session.add(model)
-                session.commit()
-                insert_model_files(session, model.id, model_path)
+                pending.append((model, model_path))
+                if len(pending) >= BATCH_SIZE:
+                    insert_models(
+                        session, pending, executor, fast_hash, use_copy, reuse_digests
+                    )
+                    now = datetime.now()
+                    pending = []
+    if pending:
+        insert_models(session, pending, executor, fast_hash, use_copy, reuse_digests)
+
+
+def insert_models(
+    session,
+    pending,
+    executor=None,
+    fast_hash=False,
+    use_copy=False,
+    reuse_digests=False,
+):
+    models = [model for model, _ in pending]
+    # Files already scraped by a previous run keep their SHA-512 digest
+    if reuse_digests and not fast_hash:
+        known = load_known_files(session, models)
+    else:
+        known = {}
+    # Don't stay idle in a transaction while hashing, this also commits the
+    # creators and collections of the batch
+    session.commit()
+    # Model folders are independent subtrees, scan them concurrently
+    folders = [model_path for _, model_path in pending]
+    scanned = list(
+        executor.map(list_files, folders) if executor else map(list_files, folders)
+    )
+    digests = digest_files(
+        [(files, known.get(model.path)) for model, files in zip(models, scanned)],
+        executor,
+        fast_hash,
+    )
+    # The write transaction only lasts as long as the INSERTs: a single flush
+    # inserts the models and fetches their ids, then their files follow
+    session.add_all(models)
+    session.flush()
+    for model, files in zip(models, scanned):
+        insert_model_files(
+            session,
+            model.id,
+            files,
+            digests,
+            fast_hash,
+            use_copy,
+            now=model.created_at,
+            reuse_digests=reuse_digests,
+        )
+    session.commit()
 
 
 def get_infos(path):
@@ -230,50 +534,85 @@ def get_infos(path):
     return creator, collection, model_name, uuid
 
 
-# Function to create or retrieve a creator from the database
-def get_or_create_creator(session, name):
-    creator = session.query(Creator).filter_by(name=name).first()
-    if creator:
-        return creator
-    else:
-        creator = Creator(
-            name=name,
-            created_at=datetime.now(),
-            updated_at=datetime.now(),
-        )
-        session.add(creator)
-        session.commit()
-        return creator
-
-
-# Function to create or retrieve a collection from the database
-def get_or_create_collection(session, name, collection_id):
-    collection = (
-        session.query(Collection)
-        .filter_by(name=name, collection_id=collection_id)
-        .first()
+def warm_caches(session):
+    for id_, name in session.execute(select(Creator.id, Creator.name)):
+        _creator_cache[name] = id_
+    for id_, name, collection_id in session.execute(
+        select(Collection.id, Collection.name, Collection.collection_id)
+    ):
+        _collection_cache[(name, collection_id)] = id_
+
+
+# Function to create or retrieve a creator id from the database
+def get_or_create_creator(session, name, now=None):
+    if name in _creator_cache:
+        return _creator_cache[name]
+    now = now or datetime.now()
+    statement = (
+        pg_insert(Creator)
+        .values(name=name, created_at=now, updated_at=now)
+        .on_conflict_do_nothing(index_elements=["name"])
+        .returning(Creator.id)
     )
-    if collection:
-        return collection
-    else:
-        collection = Collection(
+    creator_id = session.execute(statement).scalar()
+    if creator_id is None:
+        creator_id = session.execute(
+            select(Creator.id).where(Creator.name == name)
+        ).scalar()
+    _creator_cache[name] = creator_id
+    return creator_id
+
+
+# Function to create or retrieve a collection id from the database
+def get_or_create_collection(session, name, collection_id, now=None):
+    key = (name, collection_id)
+    if key in _collection_cache:
+        return _collection_cache[key]
+    now = now or datetime.now()
+    statement = (
+        pg_insert(Collection)
+        .values(
             name=name,
             collection_id=collection_id,
-            created_at=datetime.now(),
-            updated_at=datetime.now(),
+            created_at=now,
+            updated_at=now,
         )
-        session.add(collection)
-        session.commit()
-        return collection
-
-
-def init_engine(uri):
-    engine = create_engine(uri)
+        .on_conflict_do_nothing(index_elements=["name"])
+        .returning(Collection.id)
+    )
+    id_ = session.execute(statement).scalar()
+    if id_ is None:
+        id_ = session.execute(
+            select(Collection.id).where(Collection.name == name)
+        ).scalar()
+    _collection_cache[key] = id_
+    return id_
+
+
+def init_engine(uri, fast_unsafe=False):
+    options = dict(
+        insertmanyvalues_page_size=BATCH_SIZE,
+        pool_pre_ping=True,
+        isolation_level="READ COMMITTED",
+    )
+    engine = create_engine(uri, **options)
+    if fast_unsafe:
+        event.listen(engine, "connect", disable_synchronous_commit)
     Session_ = sessionmaker(bind=engine)
     session = Session_()
     return session
 
 
+def disable_synchronous_commit(dbapi_connection, connection_record):
+    """Don't wait for the WAL flush on commit, for every pooled connection"""
+    autocommit = dbapi_connection.autocommit
+    dbapi_connection.autocommit = True
+    cursor = dbapi_connection.cursor()
+    cursor.execute("SET SESSION synchronous_commit = off")
+    cursor.close()
+    dbapi_connection.autocommit = autocommit
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Scrape data from a folder structure and insert it into a database."
@@ -290,7 +629,42 @@ def main():
         action="store_true",
         help="Don't insert data into the database, just print it",
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=2 * (os.cpu_count() or 1),
+        help="Number of threads used to compute file digests",
+    )
+    parser.add_argument(
+        "--fast-hash",
+        action="store_true",
+        help="Store a BLAKE3 digest in model_files.fast_digest instead of the SHA-512 one",
+    )
+    parser.add_argument(
+        "--copy",
+        action="store_true",
+        help="Write model files with COPY FROM STDIN, faster for very large libraries",
+    )
+    parser.add_argument(
+        "--reuse-digests",
+        action="store_true",
+        help=(
+            "Store file mtimes in model_files.mtime_ns and don't hash again the"
+            " files whose size and mtime match a previous run"
+        ),
+    )
+    parser.add_argument(
+        "--fast-unsafe",
+        action="store_true",
+        help=(
+            "Turn off synchronous_commit for the run. Commits stop waiting for the"
+            " WAL flush, so a database crash can lose the last batches: re-run"
+            " the scrape from the start if that happens"
+        ),
+    )
     args = parser.parse_args()
+    if args.fast_hash and blake3 is None:
+        parser.error("--fast-hash requires the blake3 package")
 
     logging.basicConfig(level=logging.INFO)
 
@@ -298,10 +672,21 @@ def main():
     if args.dry_run:
         session = MockSession()
     else:
-        session = init_engine(args.psql_uri)
+        session = init_engine(args.psql_uri, args.fast_unsafe)
 
     # Call the function to insert data into the table
-    insert_folders(session, args.root_folder, args.library_id)
+    # hashlib releases the GIL while hashing, so threads scale across cores
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        insert_folders(
+            session,
+            args.root_folder,
+            args.library_id,
+            executor,
+            args.fast_hash,
+            # A dry run has no connection to COPY into, print the INSERTs instead
+            args.copy and not args.dry_run,
+            args.reuse_digests,
+        )
 
 
 if __name__ == "__main__":